@@ -1,68 +1,163 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
-import urllib.parse
+import base64
+import binascii
 import json
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from threading import Lock
+from threading import Thread
+import queue
 import time
 
 BASE_URL = "http://rcomp-cases.wxzheng.pro/api"
+FILE_CONTENT_URL = f"{BASE_URL}/file-content"
 
 # Paths relative to this script
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 TARGET_ROOT = os.path.normpath(os.path.join(SCRIPT_DIR, "..", "@official"))
 META_FILE = os.path.join(TARGET_ROOT, "stages.json")
 
-# Thread-safe print lock
-print_lock = Lock()
+# Number of concurrent download threads, overridable via RCOMP_WORKERS
+DEFAULT_POOL_WORKERS = 32
+
+def _pool_workers_from_env():
+    """Read RCOMP_WORKERS at startup, falling back to the default and clamping to at least 1"""
+    value = os.environ.get("RCOMP_WORKERS")
+    if value is None:
+        return DEFAULT_POOL_WORKERS
+    try:
+        workers = int(value)
+    except ValueError:
+        print(f"Warning: invalid RCOMP_WORKERS={value!r}, using {DEFAULT_POOL_WORKERS}")
+        return DEFAULT_POOL_WORKERS
+    if workers < 1:
+        print("Warning: RCOMP_WORKERS must be at least 1, using 1")
+        return 1
+    return workers
+
+POOL_WORKERS = _pool_workers_from_env()
+
+# Minimum number of seconds between progress lines
+PROGRESS_INTERVAL = 0.1
+
+# Shared session so worker threads reuse pooled connections to the API host
+SESSION = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=POOL_WORKERS * 2,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504]),
+)
+SESSION.mount("http://", _adapter)
+SESSION.mount("https://", _adapter)
+
+# All output goes through this queue and is written by a single printer thread
+print_queue = queue.SimpleQueue()
 
 def thread_safe_print(message):
-    with print_lock:
+    print_queue.put(message)
+
+def _print_worker():
+    for message in iter(print_queue.get, None):
         print(message)
 
-def download_file_content(url, path):
+def write_if_changed(path, data):
+    """Write bytes to path unless the file already holds exactly that content"""
+    try:
+        with open(path, 'rb') as f:
+            if f.read() == data:
+                return False
+    except FileNotFoundError:
+        pass
+    # Unbuffered write to a temp file, then swap it in so a killed run never leaves
+    # a truncated file behind; no fsync, as before
+    tmp_path = path + ".tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+    try:
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+        finally:
+            os.close(fd)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    return True
+
+def download_file_content(url, params, path):
     try:
-        response = requests.get(url, stream=True)
+        response = SESSION.get(url, params=params)
         if response.status_code == 200:
-            os.makedirs(os.path.dirname(path), exist_ok=True)
-            
-            # Parse JSON response and extract content
-            content_data = response.json()
+            # Servers that honour raw=1 send the file body as-is
+            content_type = response.headers.get("Content-Type", "")
+            if not content_type.startswith("application/json"):
+                write_if_changed(path, response.content)
+                return True
+
+            # Otherwise fall back to the JSON envelope; json accepts UTF-8 bytes
+            content_data = json.loads(response.content)
             if "content" in content_data:
-                with open(path, 'w', encoding='utf-8') as f:
-                    f.write(content_data["content"])
+                # Binary-safe envelopes declare base64; anything else is plain text
+                if content_data.get("encoding") == "base64":
+                    data = base64.b64decode(content_data["content"], validate=True)
+                else:
+                    data = content_data["content"].encode('utf-8')
+                write_if_changed(path, data)
                 return True
             else:
-                thread_safe_print(f"No 'content' field found in response for {url}")
+                thread_safe_print(f"No 'content' field found in response for {response.url}")
                 return False
         else:
-            thread_safe_print(f"Failed to download {url}, status code: {response.status_code}")
+            thread_safe_print(f"Failed to download {response.url}, status code: {response.status_code}")
             return False
     except requests.exceptions.RequestException as e:
-        thread_safe_print(f"Error downloading {url}: {e}")
+        thread_safe_print(f"Error downloading {params['filePath']}: {e}")
+        return False
+    except binascii.Error as e:
+        thread_safe_print(f"Error decoding base64 content from {response.url}: {e}")
         return False
-    except json.JSONDecodeError as e:
-        thread_safe_print(f"Error parsing JSON from {url}: {e}")
+    except ValueError as e:
+        # Covers JSONDecodeError as well as UnicodeDecodeError on non-UTF-8 bodies
+        thread_safe_print(f"Error parsing JSON from {response.url}: {e}")
+        return False
+    except IOError as e:
+        thread_safe_print(f"Error writing {path}: {e}")
         return False
 
 def save_testcase_info(testcase_info, path):
     try:
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-        with open(path, 'w') as f:
-            json.dump(testcase_info, f, indent=4)
+        write_if_changed(path, json.dumps(testcase_info, indent=4).encode('utf-8'))
         return True
     except IOError as e:
         thread_safe_print(f"Error saving testcase info to {path}: {e}")
         return False
 
-def download_task(stage_name, testcase_name, path_key, file_path):
-    """Single download task for threading"""
-    encoded_file_path = urllib.parse.quote(file_path, safe='')
-    download_url = f"{BASE_URL}/file-content?stageName={stage_name}&filePath={encoded_file_path}"
-    local_path = os.path.join(TARGET_ROOT, stage_name, testcase_name, os.path.basename(file_path))
-    
+def fetch_testcases(stage_name):
+    """Fetch the testcase list of a stage, or None if it could not be retrieved"""
+    try:
+        response = SESSION.get(f"{BASE_URL}/stages/{stage_name}/testcases")
+        if response.status_code != 200:
+            return None
+        return json.loads(response.content)["testcases"]
+    except requests.exceptions.RequestException as e:
+        thread_safe_print(f"Error fetching testcases for stage {stage_name}: {e}")
+        return None
+    except ValueError as e:
+        thread_safe_print(f"Error parsing testcases for stage {stage_name}: {e}")
+        return None
+    except KeyError as e:
+        thread_safe_print(f"Key not found in testcases response for stage {stage_name}: {e}")
+        return None
+
+def download_task(stage_name, testcase_name, path_key, params, local_path):
+    """Single download task for threading; request params and local path are precomputed"""
     thread_safe_print(f"Downloading {local_path}")
-    success = download_file_content(download_url, local_path)
+    success = download_file_content(FILE_CONTENT_URL, params, local_path)
     
     return {
         'stage_name': stage_name,
@@ -72,17 +167,17 @@ def download_task(stage_name, testcase_name, path_key, file_path):
         'success': success
     }
 
-def main():
+def run():
     try:
         # Ensure target root exists
         os.makedirs(TARGET_ROOT, exist_ok=True)
 
-        stages_response = requests.get(f"{BASE_URL}/stages")
+        stages_response = SESSION.get(f"{BASE_URL}/stages")
         if stages_response.status_code != 200:
-            print("Failed to get stages")
+            thread_safe_print("Failed to get stages")
             return
 
-        stages_payload = stages_response.json()
+        stages_payload = json.loads(stages_response.content)
 
         # Compare git hash with cached metadata to decide whether to skip
         current_hash = stages_payload.get("gitInfo", {}).get("git_hash")
@@ -90,107 +185,125 @@ def main():
         previous_payload = None
         if os.path.exists(META_FILE):
             try:
-                with open(META_FILE, 'r', encoding='utf-8') as f:
-                    previous_payload = json.load(f)
+                with open(META_FILE, 'rb') as f:
+                    previous_payload = json.loads(f.read())
                     previous_hash = previous_payload.get("gitInfo", {}).get("git_hash")
             except Exception:
                 previous_hash = None
                 previous_payload = None
 
         if previous_hash and current_hash and previous_hash == current_hash:
-            print("No update detected (git hash unchanged). Skipping download.")
+            thread_safe_print("No update detected (git hash unchanged). Skipping download.")
             return
 
         # Persist the latest stages metadata for future comparisons
         try:
-            with open(META_FILE, 'w', encoding='utf-8') as f:
-                json.dump(stages_payload, f, indent=4)
+            write_if_changed(META_FILE, json.dumps(stages_payload, indent=4).encode('utf-8'))
         except IOError as e:
-            print(f"Warning: failed to write metadata file {META_FILE}: {e}")
+            thread_safe_print(f"Warning: failed to write metadata file {META_FILE}: {e}")
 
         stages = stages_payload["stages"]
 
         # Determine which stages changed based on last_updated, compared to cached metadata
-        previous_stages_by_name = {}
+        previous_last_updated = {}
         if previous_payload and isinstance(previous_payload.get("stages"), list):
-            previous_stages_by_name = {s.get("name"): s for s in previous_payload.get("stages", [])}
+            previous_last_updated = {s.get("name"): s.get("last_updated") for s in previous_payload["stages"]}
 
-        changed_stages = []
-        for stage in stages:
-            name = stage.get("name")
-            last_updated = stage.get("last_updated")
-            prev = previous_stages_by_name.get(name)
-            if prev is None or prev.get("last_updated") != last_updated:
-                changed_stages.append(stage)
+        # A sentinel default marks stages missing from the cache as changed
+        missing = object()
+        changed_stages = [
+            stage for stage in stages
+            if previous_last_updated.get(stage.get("name"), missing) != stage.get("last_updated")
+        ]
 
         if previous_payload is not None and not changed_stages:
-            print("No stages changed since last run. Nothing to update.")
+            thread_safe_print("No stages changed since last run. Nothing to update.")
             return
         
-        # Collect all download tasks
-        download_tasks = []
-        
         # If first run (no previous_payload), process all stages. Otherwise, only changed stages
         stages_to_process = stages if previous_payload is None else changed_stages
         if previous_payload is not None:
             names = ", ".join(s.get("name") for s in stages_to_process)
-            print(f"Updating {len(stages_to_process)} stage(s): {names}")
-
-        for stage in stages_to_process:
-            stage_name = stage["name"]
-            testcases_response = requests.get(f"{BASE_URL}/stages/{stage_name}/testcases")
-            if testcases_response.status_code != 200:
-                print(f"Failed to get testcases for stage {stage_name}")
-                continue
-
-            testcases = testcases_response.json()["testcases"]
-            for testcase in testcases:
-                testcase_name = testcase["name"]
-                
-                # Save testcase info (non-threaded as it's quick)
-                testcase_info_path = os.path.join(TARGET_ROOT, stage_name, testcase_name, "testcase_info.json")
-                print(f"Saving testcase info for {testcase_name}")
-                save_testcase_info(testcase, testcase_info_path)
-
-                # Collect download tasks for threading
-                for path_key in ["source_path", "input_path", "output_path"]:
-                    if path_key in testcase and testcase[path_key]:
-                        file_path = testcase[path_key]
-                        download_tasks.append((stage_name, testcase_name, path_key, file_path))
-
-        # Execute downloads with thread pool
-        if download_tasks:
-            print(f"Starting {len(download_tasks)} downloads with thread pool...")
-            max_workers = min(10, len(download_tasks))  # Limit concurrent downloads
-            
-            with ThreadPoolExecutor(max_workers=max_workers) as executor:
-                # Submit all download tasks
-                future_to_task = {
-                    executor.submit(download_task, stage_name, testcase_name, path_key, file_path): 
-                    (stage_name, testcase_name, path_key, file_path)
-                    for stage_name, testcase_name, path_key, file_path in download_tasks
+            thread_safe_print(f"Updating {len(stages_to_process)} stage(s): {names}")
+
+        download_futures = []
+        # Threads are spawned on demand, so small runs never start the full pool
+        with ThreadPoolExecutor(max_workers=POOL_WORKERS) as executor:
+            # Fetch all testcase lists concurrently; downloads for a stage start as soon as its list arrives
+            with ThreadPoolExecutor(max_workers=max(1, len(stages_to_process))) as list_executor:
+                future_to_stage = {
+                    list_executor.submit(fetch_testcases, stage["name"]): stage["name"]
+                    for stage in stages_to_process
                 }
-                
-                # Process completed downloads
+
+                for list_future in as_completed(future_to_stage):
+                    stage_name = future_to_stage[list_future]
+                    testcases = list_future.result()
+                    if testcases is None:
+                        thread_safe_print(f"Failed to get testcases for stage {stage_name}")
+                        continue
+
+                    for testcase in testcases:
+                        testcase_name = testcase["name"]
+
+                        # Create the testcase directory once here so the workers only write files
+                        testcase_dir = os.path.join(TARGET_ROOT, stage_name, testcase_name)
+                        os.makedirs(testcase_dir, exist_ok=True)
+
+                        # Save testcase info (non-threaded as it's quick)
+                        testcase_info_path = os.path.join(testcase_dir, "testcase_info.json")
+                        thread_safe_print(f"Saving testcase info for {testcase_name}")
+                        save_testcase_info(testcase, testcase_info_path)
+
+                        # Hand the files to the download pool
+                        for path_key in ["source_path", "input_path", "output_path"]:
+                            if path_key in testcase and testcase[path_key]:
+                                file_path = testcase[path_key]
+                                params = {"stageName": stage_name, "filePath": file_path, "raw": 1}
+                                local_path = os.path.join(testcase_dir, os.path.basename(file_path))
+                                download_futures.append(
+                                    executor.submit(download_task, stage_name, testcase_name, path_key, params, local_path)
+                                )
+
+            # Process completed downloads
+            if download_futures:
+                thread_safe_print(f"Queued {len(download_futures)} downloads on thread pool...")
                 completed = 0
                 failed = 0
-                for future in as_completed(future_to_task):
+                last_report = time.monotonic()
+                for future in as_completed(download_futures):
                     result = future.result()
                     completed += 1
                     if not result['success']:
                         failed += 1
-                    
-                    if completed % 10 == 0 or completed == len(download_tasks):
-                        thread_safe_print(f"Progress: {completed}/{len(download_tasks)} completed, {failed} failed")
-            
-            print(f"Download completed: {completed - failed}/{completed} successful")
+
+                    # Report on a timer rather than per N files so large runs don't flood the output
+                    now = time.monotonic()
+                    if now - last_report >= PROGRESS_INTERVAL or completed == len(download_futures):
+                        last_report = now
+                        thread_safe_print(f"Progress: {completed}/{len(download_futures)} completed, {failed} failed")
+
+        if download_futures:
+            thread_safe_print(f"Download completed: {completed - failed}/{completed} successful")
         else:
-            print("No files to download")
+            thread_safe_print("No files to download")
             
     except requests.exceptions.RequestException as e:
-        print(f"An error occurred: {e}")
+        thread_safe_print(f"An error occurred: {e}")
+    except ValueError as e:
+        # Covers JSONDecodeError as well as UnicodeDecodeError on non-UTF-8 bodies
+        thread_safe_print(f"Error parsing JSON response: {e}")
     except KeyError as e:
-        print(f"Key not found in JSON response: {e}")
+        thread_safe_print(f"Key not found in JSON response: {e}")
+
+def main():
+    printer = Thread(target=_print_worker, daemon=True)
+    printer.start()
+    try:
+        run()
+    finally:
+        print_queue.put(None)
+        printer.join()
 
 if __name__ == "__main__":
     main()